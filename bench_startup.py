@@ -0,0 +1,41 @@
+"""
+Measure the import time of the experiment modules and entry points.
+
+Each import runs in a fresh interpreter so nothing is cached between runs.
+The heavy modules are listed as well to show what a lazy import saves.
+"""
+import argparse
+import subprocess
+import sys
+
+MODULES = ['pepper_connector', 'session_tools', 'calibration_experiment',
+           'numpy', 'cv2', 'PIL.Image', 'pandas', 'psychopy.visual']
+
+
+def importTime(module, repeats=5):
+    """
+    Returns the best wall time in seconds of `import module` in a new
+    interpreter, minus the interpreter startup itself. None if it fails.
+    """
+    code = 'import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)'.format(module)
+    best = None
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if out.returncode != 0:
+            return None
+        t = float(out.stdout.decode().strip().splitlines()[-1])
+        best = t if best is None else min(best, t)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("modules", type=str, nargs='*', default=MODULES)
+    args = parser.parse_args()
+    for module in args.modules:
+        t = importTime(module, args.repeats)
+        if t is None:
+            print('{:<25s} not importable'.format(module))
+        else:
+            print('{:<25s} {:8.1f} ms'.format(module, t * 1000))
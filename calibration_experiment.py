@@ -5,16 +5,125 @@ Created on Fri Jan 25 13:04:52 2019
 @author: User1
 """
 import numpy as np
-import pandas as pd
 import time
 import datetime
-import cv2
 import os
-from psychopy import visual, core, event, monitors
 import random
-from pepper_connector import socket_connection
-from multiprocessing import Process, Manager
-from threading import Thread
+from pepper_connector import socket_connection, OUTPUT_FORMATS
+from stereo import splitStereo, StereoRectifier
+
+# psychopy, pandas and cv2 are imported where they are used so that tools
+# which only need parts of this module do not pay for loading them.
+video_capture = None
+# Stand-in for the psychopy visual, core and event modules, see headless.py
+backend = None
+
+
+def _psychopy():
+    """
+    Returns the visual, core and event modules of the active backend
+    """
+    if backend is not None:
+        return backend.visual, backend.core, backend.event
+    from psychopy import visual, core, event
+    return visual, core, event
+
+
+class PhaseProfile():
+    """
+    Collects the wall time spent in each named phase of the calibration loop
+    """
+    def __init__(self):
+        self.times = {}
+        self.last = time.perf_counter()
+
+    def mark(self):
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.times.setdefault(phase, []).append(now - self.last)
+        self.last = now
+
+    def add(self, phase, dt):
+        self.times.setdefault(phase, []).append(dt)
+
+    def summary(self):
+        """
+        Print and return {phase: (count, mean ms, p95 ms, max ms, total s)}
+        """
+        result = {}
+        for phase, t in self.times.items():
+            t = np.sort(np.array(t))
+            result[phase] = (len(t), 1000 * t.mean(), 1000 * t[int(0.95 * (len(t) - 1))],
+                             1000 * t[-1], t.sum())
+            print('{:<10s} n={:<6d} mean={:8.3f} ms  p95={:8.3f} ms  max={:8.3f} ms  total={:7.2f} s'.format(
+                phase, *result[phase]))
+        return result
+
+
+class FlipTimer():
+    """
+    Trial timing in display refreshes. Durations are rounded to whole frames
+    and waited out by flipping, so stimuli stay locked to the screen and the
+    time between flips can be used for other work. The interval of every
+    flip since startTrial is kept in intervals, trialStats() summarises
+    them.
+    """
+    def __init__(self, win, framePeriod):
+        self.win = win
+        self.framePeriod = framePeriod
+        self.lastFlip = None
+        self.intervals = []
+
+    def nFrames(self, secs):
+        return max(int(round(secs / self.framePeriod)), 1)
+
+    def framesSince(self, t):
+        return int(round((self.lastFlip - t) / self.framePeriod))
+
+    def flip(self):
+        t = self.win.flip()
+        if self.lastFlip is not None:
+            self.intervals.append(t - self.lastFlip)
+        self.lastFlip = t
+        return t
+
+    def wait(self, secs, draw=None, task=None):
+        """
+        Show draw() for secs, task() runs after every flip
+        """
+        for _ in range(self.nFrames(secs)):
+            if draw is not None:
+                draw()
+            self.flip()
+            if task is not None:
+                task()
+
+    def pause(self):
+        """
+        Stop interval logging while the screen is not flipped, e.g. during
+        a key wait
+        """
+        self.lastFlip = None
+        self.win.recordFrameIntervals = False
+
+    def resume(self):
+        self.win.recordFrameIntervals = True
+
+    def startTrial(self):
+        self.intervals = []
+
+    def trialStats(self):
+        """
+        Returns the number of flips, the number of missed refreshes and the
+        longest flip interval in seconds since startTrial
+        """
+        intervals = np.array(self.intervals)
+        if not len(intervals):
+            return 0, 0, 0.
+        dropped = np.maximum(np.round(intervals / self.framePeriod) - 1, 0)
+        return len(intervals), int(dropped.sum()), intervals.max()
 
 
 def getMac():
@@ -99,6 +208,8 @@ def drawText(win,
     1.2606524216243997
     """
 
+    visual, core, event = _psychopy()
+
     if np.sum(np.array(textColor) == 0) == 3 and np.sum(win.color < 100) == 3:
         textColor = [255, 255, 255]
 
@@ -155,6 +266,8 @@ def getKey(allowedKeys=['left', 'right'], waitForKey=True, timeOut=0):
     >>> key # the 'left' key is pressed after 156 seconds'
     ('left', 156.5626505338878)
     """
+    visual, core, event = _psychopy()
+
     if waitForKey:
         while True:
             # Get key
@@ -260,7 +373,84 @@ def drawArrow(point, lr='left', col=[0, 0, 0], arrowLineW = 0, arrowLine = None,
     arrowHead.draw()
 
 
-def calibration(win, fileName, calibration, pc='default', nrPoints=15, dotColor=[255, 255, 255], ip="192.168.0.167", port= 12345, camera = 4):
+def pulseRadii(dotRad, minDotRad, maxDotRad, radStep):
+    """
+    All radii the pulsating dot can take, dotRad + k * radStep for the steps k
+    between the first radius below minDotRad and the first above maxDotRad
+    """
+    kMax = int(np.floor((maxDotRad - dotRad) / radStep)) + 1
+    kMin = -int(np.floor((dotRad - minDotRad) / radStep)) - 1
+    return [dotRad + k * radStep for k in range(kMin, kMax + 1)]
+
+
+class StimulusCache():
+    """
+    Dot and arrow stimuli built once at startup. Changing radius, fillColor
+    or ori on a psychopy shape rebuilds its vertices, so every radius and
+    every arrow direction and colour gets its own stimulus and drawing only
+    moves it.
+
+    Parameters
+    ----------
+    visual : psychopy.visual or a stand-in
+    win : psychopy window
+    radii : list of floats
+        Radii of the outer dot, see pulseRadii
+    arrowColors : list of [R,G,B]
+        Colors in which arrows are drawn
+    """
+    def __init__(self, visual, win, radii, dotColor, bgColor, innerRad,
+                 arrowLineW, arrowColor, arrowColors):
+        self.visual = visual
+        self.win = win
+        self.dotColor = dotColor
+        self.bgColor = bgColor
+        self.arrowLineW = arrowLineW
+        self.dots = {}
+        for rad in radii:
+            self._dot(rad)
+        self.innerDot = visual.Circle(win, radius=innerRad, lineWidth=1, fillColorSpace='rgb255',
+                                      lineColorSpace='rgb255', lineColor=bgColor, fillColor=bgColor,
+                                      edges=40, pos=[0, 0])
+        self.arrows = {}
+        for lr, ori in (('left', 270), ('right', 90)):
+            for col in arrowColors:
+                line = visual.Rect(win, width=arrowLineW, height=arrowLineW / 5, fillColorSpace='rgb255',
+                                   lineColorSpace='rgb255', lineColor=arrowColor, fillColor=col,
+                                   lineWidth=0, pos=[0, 0])
+                head = visual.Polygon(win, radius=arrowLineW / 2, fillColorSpace='rgb255',
+                                      lineColorSpace='rgb255', lineColor=arrowColor, fillColor=col,
+                                      lineWidth=0, ori=ori, pos=[0, 0])
+                self.arrows[(lr, tuple(col))] = (line, head)
+
+    def _dot(self, rad):
+        key = round(rad, 6)
+        if key not in self.dots:
+            # Only happens for radii missing from the startup list
+            self.dots[key] = self.visual.Circle(self.win, radius=rad, lineWidth=1, fillColorSpace='rgb255',
+                                                lineColorSpace='rgb255', lineColor=self.bgColor,
+                                                fillColor=self.dotColor, edges=40, pos=[0, 0])
+        return self.dots[key]
+
+    def drawDot(self, point, rad):
+        outer = self._dot(rad)
+        outer.pos = point
+        outer.draw()
+        self.innerDot.pos = point
+        self.innerDot.draw()
+
+    def drawArrow(self, point, lr='left', col=[0, 0, 0]):
+        line, head = self.arrows[(lr, tuple(col))]
+        offset = -self.arrowLineW / 2 if lr == 'left' else self.arrowLineW / 2
+        line.pos = point
+        line.draw()
+        head.pos = [point[0] + offset, point[1]]
+        head.draw()
+
+
+def calibration(win, fileName, calibration, pc='default', nrPoints=15, dotColor=[255, 255, 255], ip="192.168.0.167", port= 12345, camera = 4,
+                connect=None, profile=None, seqHeader=False, motionRate=None, stereoCalib=None,
+                recordWire=None, outputFormat='bgr', maxLostFrames=600):
     """
     Custom calibration using psychoLink. It uses the background
     color which is set in win. Flips the screen empty before returning.
@@ -274,6 +464,29 @@ def calibration(win, fileName, calibration, pc='default', nrPoints=15, dotColor=
         9,13,15 or 25
     dotColor : list, [R,G,B]
         The RGB color of the validation dot
+    connect : socket_connection or compatible frame source
+        If None a socket_connection to ip:port is opened, it is closed
+        again when calibration() returns or exits
+    profile : PhaseProfile
+        Receives the time spent in each phase of the dot loop
+    seqHeader : Bool
+        Ask the robot for frame counter and capture time with every frame
+    motionRate : float
+        If set, head and look commands are coalesced and sent at most
+        motionRate times per second from a separate thread
+    stereoCalib : string
+        .npz calibration used to rectify the views of the stereo camera
+        modes, see stereo.py. Stereo frames are always split and stored as
+        a left (fName) and right (fNameR) view with the same labels.
+    recordWire : string
+        Record the robot traffic to this file, see wire_replay.py
+    outputFormat : string
+        Colour and resolution of the stored frames, see
+        pepper_connector.OUTPUT_FORMATS, e.g. 'y_half' for half size grayscale
+    maxLostFrames : int
+        Number of frames lost in a row after which the session ends and the
+        frames stored so far are returned. Escape is also checked on every
+        lost frame.
 
     Returns
     -------
@@ -284,6 +497,12 @@ def calibration(win, fileName, calibration, pc='default', nrPoints=15, dotColor=
     --------
 
     """
+    import cv2
+    import pandas as pd
+    visual, core, event = _psychopy()
+    if profile is None:
+        profile = PhaseProfile()
+
     # Get required information from the supplied window
     xSize, ySize = win.size
     bgColor = list(win.color)
@@ -293,7 +512,7 @@ def calibration(win, fileName, calibration, pc='default', nrPoints=15, dotColor=
     textColor = [255, 0, 0]
     waitForSacc = 1
     radStep = 0.75
-    stepDir = -radStep
+    stepDir = -1
     dotRad = xSize / 75
     maxDotRad = xSize / 60
     minDotRad = xSize / 300
@@ -303,11 +522,17 @@ def calibration(win, fileName, calibration, pc='default', nrPoints=15, dotColor=
     leftRight = ['left', 'right']
     totalDots = nrPoints + nRandDots
     nFrames = totalDots * nFramesPerDot
-    cols = ['frameNr', 'x', 'y', 'dotNr', 'arrowOri', 'Resp', 'corrResp', 'fName', 'sampTime']  # for pandas dataframe
+    cols = ['frameNr', 'x', 'y', 'dotNr', 'arrowOri', 'Resp', 'corrResp', 'fName', 'fNameR', 'outputFormat', 'sampTime',
+            'camSeq', 'camTime', 'frameHash', 'dupFrame', 'gapFrames',
+            'headPitch', 'headYaw', 'headCmdAge', 'nDropped',
+            'trialFlips', 'trialDropped', 'trialMaxInterval', 'trialIntervals']  # for pandas dataframe
     headerInfo = pd.DataFrame([], columns=cols)
     headerInfo['pc'] = pc
     headerInfo['resX'] = xSize
     headerInfo['resY'] = ySize
+    # One dict per stored frame, the dataframe is built after the loop so no
+    # per frame pandas work is done between flips
+    rows = []
     # calDotNr = np.zeros(nFrames)
 
     if np.sum(np.array(textColor) == 0) == 3 and np.sum(win.color < 100) == 3:
@@ -315,46 +540,54 @@ def calibration(win, fileName, calibration, pc='default', nrPoints=15, dotColor=
     if np.sum(np.array(dotColor) == 0) == 3 and np.sum(win.color < 100) == 3:
         dotColor = [255, 255, 255]
 
-    # Initiate Dots (inner and outer dot for better fixation)
-    OuterDot = visual.Circle(win,
-                             radius=10,
-                             lineWidth=1,
-                             fillColorSpace='rgb255',
-                             lineColorSpace='rgb255',
-                             lineColor=bgColor,
-                             fillColor=dotColor,
-                             edges=40,
-                             pos=[0, 0])
-
-    InnerDot = visual.Circle(win,
-                             radius=xSize / 500,
-                             lineWidth=1,
-                             fillColorSpace='rgb255',
-                             lineColorSpace='rgb255',
-                             lineColor=bgColor,
-                             fillColor=bgColor,
-                             edges=40,
-                             pos=[0, 0])
-
-    arrowLine = visual.Rect(win,
-                            width=arrowLineW,
-                            height=arrowLineW / 5,
-                            fillColorSpace='rgb255',
-                            lineColorSpace='rgb255',
-                            lineColor=arrowColor,
-                            fillColor=arrowColor,
-                            lineWidth=0,
-                            pos=[0, 0])
-
-    arrowHead = visual.Polygon(win,
-                               radius=arrowLineW / 2,
-                               fillColorSpace='rgb255',
-                               lineColorSpace='rgb255',
-                               lineColor=arrowColor,
-                               fillColor=arrowColor,
-                               lineWidth=0,
-                               pos=[0, 0])
-
+    # Initiate Dots (inner and outer dot for better fixation) and arrows, all
+    # radii and arrow variants are prebuilt, the loops below only move them
+    stimCache = StimulusCache(visual, win, pulseRadii(dotRad, minDotRad, maxDotRad, radStep),
+                              dotColor, bgColor, xSize / 500, arrowLineW, arrowColor,
+                              [[0, 0, 0], [0, 255, 0], [255, 0, 0]])
+
+    # Flip intervals are used to count dropped display frames
+    win.refreshThreshold = win.monitorFramePeriod + 0.004
+
+    # All trial durations are counted in display refreshes
+    frameRate = win.getActualFrameRate()
+    timer = FlipTimer(win, 1. / frameRate if frameRate else win.monitorFramePeriod)
+    # Intervals are only recorded while stimuli are shown, a key wait on a
+    # text screen is not a missed refresh
+    timer.pause()
+    saccFrames = timer.nFrames(waitForSacc)
+
+    # Frames are written during the arrow and feedback pauses, not in the
+    # dot loop
+    pendingWrites = []
+
+    def writePending():
+        if pendingWrites:
+            t = time.perf_counter()
+            path, img = pendingWrites.pop(0)
+            cv2.imwrite(path, img)
+            profile.add('save', time.perf_counter() - t)
+
+    def flushWrites():
+        while pendingWrites:
+            writePending()
+
+    # A link that stays down must not hang the dot loops
+    lostFrames = 0
+
+    def sessionLost(img):
+        """
+        Count lost frames, returns True if the session has to end
+        """
+        nonlocal lostFrames
+        if img is not None:
+            lostFrames = 0
+            return False
+        lostFrames += 1
+        if lostFrames >= maxLostFrames:
+            print('ERR: {} frames lost in a row, ending the session'.format(lostFrames))
+            return True
+        return getKey(['escape'], waitForKey=False)[0] == 'escape'
 
     # Make the grid depending on the number of points for calibration
     if nrPoints == 9:
@@ -377,222 +610,316 @@ def calibration(win, fileName, calibration, pc='default', nrPoints=15, dotColor=
 
     # training for 1 position
     gridPoints = [i for i in gridPoints]
-    connect = socket_connection(ip=ip, port=port, camera=camera)
-    connect.adjust_head(-0.3, 0)
-    fCount = 0
-    #
-    # Draw the first fixation dot and wait for spacepress to start validation
-    startKey = \
-    drawText(win, textSize=xSize / 40, text='Training! \n 30 dots will appear on the screen,'
-                                                'one after the other in random order [space]', textKey=['space', 'escape'])[0]
-
-    drawText(win, textSize=xSize / 40, text=' You must look at them and select the correct arrow direction  [space]',
-             textKey=['space', 'escape'])[0]
-
-    drawText(win, textSize=xSize / 30,
-             text='Stand at the position #1 and press [space] to start the training ',
-             textKey=['space', 'escape'])[0]
-    drawDots((0, 0), dotRad, dotColor, OuterDot, InnerDot)
-    win.flip()
-    time.sleep(sampDur / 1000.)
-    if startKey[0] == 'escape':
-        escapeKey[0] = 'escape'
-        return headerInfo
-
-    # shuffle points
-    for el in range(0, nrPoints):
-        a = gridPoints[nrPoints * el: nrPoints * el + nrPoints - 1]
-        random.shuffle(a)
-        gridPoints[nrPoints * el: nrPoints * el + nrPoints - 1] = a
-
-    for i in range(0, len(gridPoints)):
-        s = time.time()
-        curFCount = 0
-        dotRadius = dotRad
-
-        # Draw arrow and wait for responsse
-        lr = np.random.choice(2)
-        respIdxStart = fCount
-
-        while True:
-            if dotRadius > maxDotRad:
-                stepDir = -radStep
-            elif dotRadius < minDotRad:
-                stepDir = radStep
-            dotRadius += stepDir
-            drawDots(gridPoints[i], dotRadius, dotColor, OuterDot, InnerDot)
-            sampTime = win.flip()
-            if (time.time() - s) > waitForSacc:
-                # Increase frame counters
-                img = connect.get_img()
-                fCount += 1
-                curFCount += 1
-
-            # Go to next dot after nFramesPerDot
-            if curFCount >= nFramesPerDot:
-                break
-
-        # Check abort
-        escapeKey = getKey(['escape'], waitForKey=False)
-        if escapeKey[0] == 'escape':
-            exit()
-
-        # Draw arrow and get response
-        respIdxEnd = fCount - 1
-        drawArrow(gridPoints[i], leftRight[lr], arrowLineW = arrowLineW, arrowLine = arrowLine, arrowHead = arrowHead)
-        win.flip()
-        time.sleep(0.150)
-        win.flip()
-        resp = getKey(timeOut=1)[0]
-        headerInfo.loc[respIdxStart:respIdxEnd, 'Resp'] = resp
-        if leftRight[lr] == resp:
-            headerInfo.loc[respIdxStart:respIdxEnd, 'corrResp'] = True
-            drawArrow(gridPoints[i], leftRight[lr], [0, 255, 0], arrowLineW, arrowLine, arrowHead)
-        else:
-            headerInfo.loc[respIdxStart:respIdxEnd, 'corrResp'] = False
-            drawArrow(gridPoints[i], leftRight[lr], [255, 0, 0], arrowLineW, arrowLine, arrowHead)
+    ownConnection = connect is None
+    if ownConnection:
+        connect = socket_connection(ip=ip, port=port, camera=camera, seq_header=seqHeader,
+                                    motion_rate=motionRate, record=recordWire, output=outputFormat)
+    try:
+        stereo = connect.stereo
+        rectifier = None
+        if stereo and stereoCalib is not None:
+            # Maps match the views of the selected output format
+            rectifier = StereoRectifier(stereoCalib, (connect.width // 2, connect.height),
+                                        OUTPUT_FORMATS[connect.output][1])
+        connect.adjust_head(-0.3, 0)
+        fCount = 0
+        #
+        # Draw the first fixation dot and wait for spacepress to start validation
+        startKey = \
+        drawText(win, textSize=xSize / 40, text='Training! \n 30 dots will appear on the screen,'
+                                                    'one after the other in random order [space]', textKey=['space', 'escape'])[0]
+
+        drawText(win, textSize=xSize / 40, text=' You must look at them and select the correct arrow direction  [space]',
+                 textKey=['space', 'escape'])[0]
+
+        drawText(win, textSize=xSize / 30,
+                 text='Stand at the position #1 and press [space] to start the training ',
+                 textKey=['space', 'escape'])[0]
+        timer.resume()
+        timer.wait(sampDur / 1000., draw=lambda: stimCache.drawDot((0, 0), dotRad))
+        if startKey[0] == 'escape':
+            escapeKey[0] = 'escape'
+            return headerInfo
+
+        # shuffle points
+        for el in range(0, nrPoints):
+            a = gridPoints[nrPoints * el: nrPoints * el + nrPoints - 1]
+            random.shuffle(a)
+            gridPoints[nrPoints * el: nrPoints * el + nrPoints - 1] = a
+
+        for i in range(0, len(gridPoints)):
+            timer.startTrial()
+            tOnset = None
+            curFCount = 0
+            radIdx = 0
+
+            # Draw arrow and wait for responsse
+            lr = np.random.choice(2)
+            respIdxStart = fCount
+
+            while True:
+                dotRadius = dotRad + radIdx * radStep
+                if dotRadius > maxDotRad:
+                    stepDir = -1
+                elif dotRadius < minDotRad:
+                    stepDir = 1
+                radIdx += stepDir
+                stimCache.drawDot(gridPoints[i], dotRad + radIdx * radStep)
+                sampTime = timer.flip()
+                if tOnset is None:
+                    tOnset = sampTime
+                if timer.framesSince(tOnset) >= saccFrames:
+                    # Increase frame counters
+                    img = connect.get_img()
+                    if sessionLost(img):
+                        # Nothing is stored during training
+                        return headerInfo
+                    if img is not None:
+                        fCount += 1
+                        curFCount += 1
+
+                # Go to next dot after nFramesPerDot
+                if curFCount >= nFramesPerDot:
+                    break
 
-        # Draw response
-        win.flip()
-        time.sleep(0.25)
+            # Check abort
+            escapeKey = getKey(['escape'], waitForKey=False)
+            if escapeKey[0] == 'escape':
+                exit()
+
+            # Draw arrow and get response
+            respIdxEnd = fCount - 1
+            timer.wait(0.150, draw=lambda: stimCache.drawArrow(gridPoints[i], leftRight[lr]))
+            timer.flip()
+            timer.pause()
+            resp = getKey(timeOut=1)[0]
+            timer.resume()
+            headerInfo.loc[respIdxStart:respIdxEnd, 'Resp'] = resp
+            if leftRight[lr] == resp:
+                headerInfo.loc[respIdxStart:respIdxEnd, 'corrResp'] = True
+                feedbackColor = [0, 255, 0]
+            else:
+                headerInfo.loc[respIdxStart:respIdxEnd, 'corrResp'] = False
+                feedbackColor = [255, 0, 0]
+
+            # Draw response
+            timer.wait(0.25, draw=lambda: stimCache.drawArrow(gridPoints[i], leftRight[lr], feedbackColor))
+            timer.flip()
+
+            # Break between blocks
+            if (i + 1) % (nrPoints * 2) == 0 and i != len(gridPoints):
+                pos = int((i + 1) / (nrPoints * 2)) + 1
+                text = 'break! Go to position: ', str(pos), ' \n\nPress space to continue'
+                timer.pause()
+                drawText(win, textSize=xSize / 30,
+                         text='break! Go to position: ' + str(pos) + ' \n\nPress space to continue')
+                timer.resume()
+                timer.wait(0.5)
+        timer.pause()
+        drawText(win, textSize=xSize / 30,
+                 text='Good job :) !!  Your training is finished... \n Now you are ready to start the experiment \n\n Press space to start')
         win.flip()
 
-        # Break between blocks
-        if (i + 1) % (nrPoints * 2) == 0 and i != len(gridPoints):
-            pos = int((i + 1) / (nrPoints * 2)) + 1
-            text = 'break! Go to position: ', str(pos), ' \n\nPress space to continue'
-            drawText(win, textSize=xSize / 30,
-                     text='break! Go to position: ' + str(pos) + ' \n\nPress space to continue')
-            win.flip()
-            time.sleep(0.5)
-    drawText(win, textSize=xSize / 30,
-             text='Good job :) !!  Your training is finished... \n Now you are ready to start the experiment \n\n Press space to start')
-    win.flip()
-
-
-    # Experiment
-    gridPoints = [i for i in gridPoints * 2 * 9]
-    # connect = socket_connection(ip=ip, port=port, camera=camera)
-    # connect.adjust_head(-0.3, 0)
-
-    # connect.adjust_head(0.2, 0)
-    # print("connection established")
-
-    # Draw the first fixation dot and wait for spacepress to start validation
-    startKey = \
-    drawText(win, textSize=xSize / 30, text='Press space to start calibration!', textKey=['space', 'escape'])[0]
-    drawDots((0, 0), dotRad, dotColor, OuterDot, InnerDot)
-    win.flip()
-    time.sleep(sampDur / 1000.)
-    if startKey[0] == 'escape':
-        escapeKey[0] = 'escape'
-        return headerInfo
-
-    # Draw the Dots dot and wait for 1 second between each dot
-    fCount = 0
-
-    # shuffle points
-    for el in range(0, nrPoints):
-        a = gridPoints[nrPoints * el: nrPoints * el + nrPoints - 1]
-        random.shuffle(a)
-        gridPoints[nrPoints * el: nrPoints * el + nrPoints - 1] = a
-
-    for i in range(0, len(gridPoints)):
-        s = time.time()
-        curFCount = 0
-        dotRadius = dotRad
 
-        # Draw arrow and wait for responsse
-        lr = np.random.choice(2)
-        respIdxStart = fCount
-
-        while True:
-            if dotRadius > maxDotRad:
-                stepDir = -radStep
-            elif dotRadius < minDotRad:
-                stepDir = radStep
-            dotRadius += stepDir
-            drawDots(gridPoints[i], dotRadius, dotColor, OuterDot, InnerDot)
-            sampTime = win.flip()
-            if (time.time() - s) > waitForSacc:
-                # Get video image
-                fName = fileName + '%05d.jpg' % (fCount + 1)
-                # print('store frame')
-                # print('fName', fName)
-                # print('calibration', calibration)
-                img = connect.get_img()
-                cv2.imwrite(calibration + '\\' + fName, img)
-                # cv2.imwrite(calibration + '\\' + fName, getFrame())
-                headerInfo.loc[fCount, 'x'] = gridPoints[i][0]
-                headerInfo.loc[fCount, 'y'] = gridPoints[i][1]
-                headerInfo.loc[fCount, 'dotNr'] = i
-                headerInfo.loc[fCount, 'arrowOri'] = leftRight[lr]
-                print(fName)
-                headerInfo.loc[fCount, 'fName'] = fName
-                headerInfo.loc[fCount, 'sampTime'] = sampTime
-
-                # Increase frame counters
-                fCount += 1
-                curFCount += 1
-
-            # Go to next dot after nFramesPerDot
-            if curFCount >= nFramesPerDot:
+        # Experiment
+        gridPoints = [i for i in gridPoints * 2 * 9]
+        # connect = socket_connection(ip=ip, port=port, camera=camera)
+        # connect.adjust_head(-0.3, 0)
+
+        # connect.adjust_head(0.2, 0)
+        # print("connection established")
+
+        # Draw the first fixation dot and wait for spacepress to start validation
+        startKey = \
+        drawText(win, textSize=xSize / 30, text='Press space to start calibration!', textKey=['space', 'escape'])[0]
+        timer.resume()
+        timer.wait(sampDur / 1000., draw=lambda: stimCache.drawDot((0, 0), dotRad))
+        if startKey[0] == 'escape':
+            escapeKey[0] = 'escape'
+            return headerInfo
+
+        # Draw the Dots dot and wait for 1 second between each dot
+        fCount = 0
+        aborted = False
+
+        # shuffle points
+        for el in range(0, nrPoints):
+            a = gridPoints[nrPoints * el: nrPoints * el + nrPoints - 1]
+            random.shuffle(a)
+            gridPoints[nrPoints * el: nrPoints * el + nrPoints - 1] = a
+
+        for i in range(0, len(gridPoints)):
+            timer.startTrial()
+            tOnset = None
+            curFCount = 0
+            radIdx = 0
+
+            # Draw arrow and wait for responsse
+            lr = np.random.choice(2)
+            respIdxStart = fCount
+            # No frames were requested since the last dot, only count skipped
+            # exposures between the captures of this dot
+            connect.reset_sequence()
+            profile.mark()
+
+            while True:
+                dotRadius = dotRad + radIdx * radStep
+                if dotRadius > maxDotRad:
+                    stepDir = -1
+                elif dotRadius < minDotRad:
+                    stepDir = 1
+                radIdx += stepDir
+                stimCache.drawDot(gridPoints[i], dotRad + radIdx * radStep)
+                profile.lap('draw')
+                sampTime = timer.flip()
+                if tOnset is None:
+                    tOnset = sampTime
+                profile.lap('flip')
+                if timer.framesSince(tOnset) >= saccFrames:
+                    # Get video image
+                    fName = fileName + ('%05d_L.jpg' if stereo else '%05d.jpg') % (fCount + 1)
+                    # print('store frame')
+                    # print('fName', fName)
+                    # print('calibration', calibration)
+                    img = connect.get_img()
+                    profile.lap('capture')
+                    if sessionLost(img):
+                        aborted = True
+                        break
+                    if img is None:
+                        # Frame lost on the wire, connection already resynced
+                        continue
+                    # Sequence check of the frame, flags duplicate and skipped exposures
+                    info = connect.frame_info
+                    row = {'x': gridPoints[i][0], 'y': gridPoints[i][1], 'dotNr': i,
+                           'arrowOri': leftRight[lr], 'fName': fName, 'outputFormat': connect.output,
+                           'sampTime': sampTime, 'nDropped': win.nDroppedFrames,
+                           'camSeq': info['seq'], 'camTime': info['camTime'], 'frameHash': info['hash'],
+                           'dupFrame': info['dup'], 'gapFrames': info['gap']}
+                    if stereo:
+                        left, right = splitStereo(img)
+                        if rectifier is not None:
+                            left, right = rectifier.rectify(left, right)
+                        fNameR = fileName + '%05d_R.jpg' % (fCount + 1)
+                        pendingWrites.append((os.path.join(calibration, fName), left))
+                        pendingWrites.append((os.path.join(calibration, fNameR), right))
+                        row['fNameR'] = fNameR
+                    else:
+                        pendingWrites.append((os.path.join(calibration, fName), img))
+                    # cv2.imwrite(os.path.join(calibration, fName), getFrame())
+                    print(fName)
+                    # Head pose in effect and seconds since it was commanded
+                    if 'head' in connect.last_motion:
+                        (pitch, yaw), tSent = connect.last_motion['head']
+                        row['headPitch'] = pitch
+                        row['headYaw'] = yaw
+                        row['headCmdAge'] = info['tRecv'] - tSent
+                    rows.append(row)
+                    profile.lap('header')
+
+                    # Increase frame counters
+                    fCount += 1
+                    curFCount += 1
+
+                # Go to next dot after nFramesPerDot
+                if curFCount >= nFramesPerDot:
+                    break
+            if aborted:
                 break
 
-        # Check abort
-        escapeKey = getKey(['escape'], waitForKey=False)
-        if escapeKey[0] == 'escape':
-            exit()
-
-        # Draw arrow and get response
-        respIdxEnd = fCount - 1
-        drawArrow(gridPoints[i], leftRight[lr], arrowLineW=arrowLineW, arrowLine = arrowLine, arrowHead=arrowHead)
-        win.flip()
-        time.sleep(0.150)
-        win.flip()
-        resp = getKey(timeOut=1)[0]
-        headerInfo.loc[respIdxStart:respIdxEnd, 'Resp'] = resp
-        if leftRight[lr] == resp:
-            headerInfo.loc[respIdxStart:respIdxEnd, 'corrResp'] = True
-            drawArrow(gridPoints[i], leftRight[lr], [0, 255, 0], arrowLineW=arrowLineW, arrowLine = arrowLine, arrowHead=arrowHead)
+            # Check abort
+            escapeKey = getKey(['escape'], waitForKey=False)
+            if escapeKey[0] == 'escape':
+                flushWrites()
+                exit()
+
+            # Draw arrow and get response
+            respIdxEnd = fCount - 1
+            timer.wait(0.150, draw=lambda: stimCache.drawArrow(gridPoints[i], leftRight[lr]), task=writePending)
+            timer.flip()
+            timer.pause()
+            resp = getKey(timeOut=1)[0]
+            timer.resume()
+            profile.lap('response')
+            corrResp = leftRight[lr] == resp
+            for row in rows[respIdxStart:respIdxEnd + 1]:
+                row['Resp'] = resp
+                row['corrResp'] = corrResp
+            if corrResp:
+                feedbackColor = [0, 255, 0]
+            else:
+                feedbackColor = [255, 0, 0]
+
+            # Draw response
+            timer.wait(0.25, draw=lambda: stimCache.drawArrow(gridPoints[i], leftRight[lr], feedbackColor),
+                       task=writePending)
+            # Writes left over are counted against this trial, not the next
+            flushWrites()
+            timer.flip()
+            profile.lap('feedback')
+
+            # Flip timing of the trial
+            flips, dropped, maxInterval = timer.trialStats()
+            intervals = [round(t, 6) for t in timer.intervals]
+            for row in rows[respIdxStart:respIdxEnd + 1]:
+                row['trialFlips'] = flips
+                row['trialDropped'] = dropped
+                row['trialMaxInterval'] = maxInterval
+                row['trialIntervals'] = intervals
+
+            # Break between blocks
+            if (i + 1) % (nrPoints * 2) == 0 and i - 1 != len(gridPoints):
+                pos = int((i + 1) / (nrPoints * 2)) + 1
+                text = 'break! Go to position: ', str(pos), ' \n\nPress space to continue'
+                timer.pause()
+                if pos!= 10:
+                    drawText(win, textSize=xSize / 30,
+                         text='break! Go to position: ' + str(pos) + ' \n\nPress space to continue')
+                if pos==4:
+                    connect.adjust_head(0.2,0)
+                if pos == 7:
+                    connect.adjust_head(0.1, 0)
+                timer.resume()
+                timer.wait(0.5)
+                profile.lap('break')
+        timer.pause()
+        if aborted:
+            # Keep the frames and labels collected so far
+            flushWrites()
         else:
-            headerInfo.loc[respIdxStart:respIdxEnd, 'corrResp'] = False
-            drawArrow(gridPoints[i], leftRight[lr], [255, 0, 0], arrowLineW=arrowLineW, arrowLine = arrowLine, arrowHead=arrowHead)
-
-        # Draw response
-        win.flip()
-        time.sleep(0.25)
+            drawText(win, textSize=xSize / 30,
+                     text='Thanks for your attention :) !!  The experiment is ended. \n Now you can take a break and ask any question you want')
         win.flip()
-
-        # Break between blocks
-        if (i + 1) % (nrPoints * 2) == 0 and i - 1 != len(gridPoints):
-            pos = int((i + 1) / (nrPoints * 2)) + 1
-            text = 'break! Go to position: ', str(pos), ' \n\nPress space to continue'
-            if pos!= 10:
-                drawText(win, textSize=xSize / 30,
-                     text='break! Go to position: ' + str(pos) + ' \n\nPress space to continue')
-            if pos==4:
-                connect.adjust_head(0.2,0)
-            if pos == 7:
-                connect.adjust_head(0.1, 0)
-            win.flip()
-            time.sleep(0.5)
-    drawText(win, textSize=xSize / 30,
-             text='Thanks for your attention :) !!  The experiment is ended. \n Now you can take a break and ask any question you want')
-    win.flip()
-    return headerInfo
+        headerInfo = pd.DataFrame(rows, columns=cols)
+        headerInfo['pc'] = pc
+        headerInfo['resX'] = xSize
+        headerInfo['resY'] = ySize
+        connect.report_stats()
+        print('Dropped {} of {} display frames'.format(win.nDroppedFrames, len(win.frameIntervals)))
+        return headerInfo
+    finally:
+        # Also stops the motion thread and flushes a wire recording
+        if ownConnection:
+            connect.close_connection()
 
 
 
 def getFrame():
+    global video_capture
+    if video_capture is None:
+        import cv2
+        video_capture = cv2.VideoCapture(0)
     return video_capture.read()[1]
 
 
 def dispCalVid(loc, f, fps=33):
-    data = pd.read_pickle(loc + '\\' + f)
+    import cv2
+    import pandas as pd
+
+    data = pd.read_pickle(os.path.join(loc, f))
     try:
         for i in range(len(data)):
-            frame = cv2.imread(loc + '\\' + data['fName'][i])
+            frame = cv2.imread(os.path.join(loc, data['fName'][i]))
             cv2.putText(frame, 'CalDot: ' + str(int(data['dotNr'][i])), (0, 25), 0, 0.7, (0, 0, 255), 2, cv2.LINE_AA)
             cv2.imshow('Calibration', frame)
             cv2.waitKey(int(1000 / fps))
@@ -644,6 +971,8 @@ def getFileName2():
 
 
 if __name__ == '__main__':
+    import cv2
+    from psychopy import visual, event, monitors
 
     # ==============================================================================
     # Settings
@@ -663,13 +992,6 @@ if __name__ == '__main__':
     port = 12345
     camera = 4  # [ 3: red_id=1, cam_id=0 res=(320,240)  ||  4: red_id=2, cam_id=0 res=(640,480) ]
 
-    # ==============================================================================
-    # Initiate webcam
-    # ==============================================================================
-    faceCascade = cv2.CascadeClassifier('haarcascade_frontalface_default.xml')
-    eye_cascade = cv2.CascadeClassifier('haarcascade_eye.xml')
-    video_capture = cv2.VideoCapture(0)
-
     # ==============================================================================
     # Initiate psychopy
     # ==============================================================================
@@ -701,13 +1023,14 @@ if __name__ == '__main__':
     # ==============================================================================
     # Save data
     # ========================================================================== ====
-    dataframe.to_pickle(participant + '\\' + fileName + 'Header.p')
-    dataframe.to_csv(participant + '\\' + fileName + 'Header.csv', index=False)
+    dataframe.to_pickle(os.path.join(participant, fileName + 'Header.p'))
+    dataframe.to_csv(os.path.join(participant, fileName + 'Header.csv'), index=False)
 
     ##==============================================================================
     # Clean up
     ##==============================================================================
-    video_capture.release()
+    if video_capture is not None:
+        video_capture.release()
     cv2.destroyAllWindows()
 
     # ==============================================================================
@@ -0,0 +1,273 @@
+"""
+Headless stand-in for the psychopy window, stimuli, clock and keyboard.
+
+Lets calibration() run without a screen: flips advance a simulated clock at
+the given refresh rate, waits are skipped and key presses come from a
+script. Combined with SyntheticSource (or any socket_connection compatible
+frame source) the whole protocol runs in seconds and the per phase timing of
+the loop itself can be profiled.
+
+    python headless.py --refresh 60
+    python headless.py --ip 10.15.3.25 --camera 4
+    python headless.py --replay session.wire
+"""
+import argparse
+import itertools
+import math
+import os
+import tempfile
+import time
+import types
+
+import numpy as np
+
+
+class SimClock():
+    """
+    Simulated experiment time in seconds
+    """
+    def __init__(self):
+        self.t = 0.0
+
+    def advance(self, dt):
+        self.t += max(dt, 0.0)
+        return self.t
+
+
+clock = SimClock()
+
+
+class HeadlessWindow():
+    """
+    Replaces psychopy.visual.Window. flip() returns the simulated time of the
+    next refresh. With realtime=True flips are also paced in wall time so that
+    a loop too slow for the refresh rate shows up in nDroppedFrames. Like
+    psychopy, intervals are only recorded with recordFrameIntervals.
+    """
+    def __init__(self, size=(1920, 1080), color=(0, 0, 0), refreshRate=60., realtime=False, **kwargs):
+        self.size = np.array(size)
+        self.color = np.array(color)
+        self.period = 1. / refreshRate
+        self.monitorFramePeriod = self.period
+        self.refreshThreshold = self.period + 0.004
+        self._record = False
+        self.realtime = realtime
+        self.nDraws = 0
+        self.flipTimes = []
+        self.frameIntervals = []
+        self.nDroppedFrames = 0
+        self._lastWall = None
+
+    @property
+    def recordFrameIntervals(self):
+        return self._record
+
+    @recordFrameIntervals.setter
+    def recordFrameIntervals(self, value):
+        # Like psychopy, the first interval after enabling is not counted
+        self._record = value
+        if value:
+            self._lastWall = None
+
+    def getActualFrameRate(self, **kwargs):
+        return 1. / self.period
+
+    def flip(self):
+        now = time.perf_counter()
+        missed = 0
+        if self._lastWall is not None:
+            elapsed = now - self._lastWall
+            if self.realtime and elapsed < self.period:
+                time.sleep(self.period - elapsed)
+                now = time.perf_counter()
+            if self.recordFrameIntervals:
+                interval = now - self._lastWall
+                self.frameIntervals.append(interval)
+                if interval > self.refreshThreshold:
+                    self.nDroppedFrames += 1
+            if self.realtime:
+                # Refreshes that passed while the loop was busy
+                missed = max(int(round((now - self._lastWall) / self.period)) - 1, 0)
+        self._lastWall = now
+        # Snap to the next refresh of the simulated display
+        t = (math.floor(clock.t / self.period + 1e-9) + 1 + missed) * self.period
+        clock.t = t
+        self.flipTimes.append(t)
+        return t
+
+    def close(self):
+        pass
+
+
+class Stim():
+    """
+    Replaces every psychopy stimulus, attributes are stored and draw() is
+    counted on the window
+    """
+    def __init__(self, win, **kwargs):
+        self.win = win
+        self.__dict__.update(kwargs)
+
+    def draw(self):
+        self.win.nDraws += 1
+
+
+class Clock():
+    def __init__(self):
+        self.start = clock.t
+
+    def getTime(self):
+        return clock.t - self.start
+
+    def reset(self):
+        self.start = clock.t
+
+
+class ScriptedKeys():
+    """
+    Replaces psychopy.event. waitKeys() pops the next scripted key, once the
+    script is empty it cycles through space, left and right so every prompt
+    in calibration() gets an allowed answer. Each press takes rt seconds.
+    """
+    def __init__(self, keys=(), rt=0.3):
+        self.keys = list(keys)
+        self.rt = rt
+        self.default = itertools.cycle(['space', 'left', 'right'])
+
+    def waitKeys(self, maxWait=float('inf'), keyList=None, timeStamped=False, **kwargs):
+        key = self.keys.pop(0) if self.keys else next(self.default)
+        clock.advance(min(self.rt, maxWait))
+        if key is None or (keyList is not None and key not in keyList):
+            return None
+        return [[key, clock.t]] if timeStamped else [key]
+
+    def getKeys(self, keyList=None, timeStamped=False, **kwargs):
+        if self.keys and (keyList is None or self.keys[0] in keyList):
+            key = self.keys.pop(0)
+            return [[key, clock.t]] if timeStamped else [key]
+        return []
+
+    def Mouse(self, **kwargs):
+        return types.SimpleNamespace(setVisible=lambda visible: None)
+
+
+class SyntheticSource():
+    """
+    socket_connection compatible frame source that returns a generated image
+    after frameDelay seconds of wall time
+    """
+    def __init__(self, width=640, height=480, frameDelay=0.0, stereo=False):
+        self.width = width
+        self.height = height
+        self.frameDelay = frameDelay
+        self.stereo = stereo
+        self.output = 'bgr'
+        self.stats = {'frames': 0, 'duplicates': 0, 'gaps': 0}
+        self.frame_info = {'seq': None, 'camTime': None, 'hash': None, 'dup': False, 'gap': 0,
+                           'tRecv': None}
+        self.last_motion = {}
+        self.commands = []
+        self._img = np.zeros((height, width, 3), dtype=np.uint8)
+        self._img[:] = np.linspace(0, 255, width, dtype=np.uint8)[None, :, None]
+
+    def get_img(self):
+        if self.frameDelay:
+            time.sleep(self.frameDelay)
+        self.stats['frames'] += 1
+        self.frame_info = {'seq': self.stats['frames'], 'camTime': clock.t, 'hash': None, 'dup': False, 'gap': 0,
+                           'tRecv': time.time()}
+        return self._img.copy()
+
+    def reset_sequence(self):
+        pass
+
+    def _command(self, *args):
+        self.commands.append(args)
+
+    def adjust_head(self, pitch, yaw):
+        self._command('head', pitch, yaw)
+        self.last_motion['head'] = ((pitch, yaw), time.time())
+
+    def look(self, x, y):
+        self._command('look', x, y)
+        self.last_motion['look'] = ((x, y), time.time())
+
+    def say(self, text):
+        self._command('say', text)
+
+    def close_connection(self):
+        pass
+
+    def report_stats(self):
+        print("Connection stats: " + ", ".join("{}={}".format(k, v) for k, v in self.stats.items()))
+        return dict(self.stats)
+
+
+# Module attributes used by calibration_experiment._psychopy()
+visual = types.SimpleNamespace(Window=HeadlessWindow, Circle=Stim, Rect=Stim, Polygon=Stim, TextStim=Stim)
+core = types.SimpleNamespace(Clock=Clock, getTime=lambda: clock.t, wait=lambda secs, **kwargs: clock.advance(secs))
+event = ScriptedKeys()
+
+
+def dryRun(connect=None, keys=(), outDir=None, nrPoints=15, **windowKwargs):
+    """
+    Run calibration() against the headless backend. Returns the header, the
+    PhaseProfile and the window (flip times and dropped frames).
+    """
+    import calibration_experiment as ce
+
+    global event
+    event = ScriptedKeys(keys)
+    clock.t = 0.0
+    if connect is None:
+        connect = SyntheticSource()
+    if outDir is None:
+        outDir = tempfile.mkdtemp(prefix='dryrun_')
+    win = HeadlessWindow(**windowKwargs)
+    profile = ce.PhaseProfile()
+    previous = ce.backend
+    ce.backend = types.SimpleNamespace(visual=visual, core=core, event=event)
+    try:
+        header = ce.calibration(win, 'dryrun_', outDir, pc='headless', nrPoints=nrPoints,
+                                connect=connect, profile=profile)
+    finally:
+        ce.backend = previous
+    return header, profile, win
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ip", type=str, default=None,
+                        help="Use the robot as frame source instead of synthetic frames")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--camera", type=int, default=4)
+    parser.add_argument("--refresh", type=float, default=60.)
+    parser.add_argument("--realtime", action='store_true', help="Pace flips at the refresh rate")
+    parser.add_argument("--frame_delay", type=float, default=0.0,
+                        help="Simulated capture latency of the synthetic source in seconds")
+    parser.add_argument("--replay", type=str, default=None,
+                        help="Use a wire recording as frame source (looped, as fast as possible)")
+    parser.add_argument("--stereo", action='store_true', help="Synthetic side by side 1280x360 frames")
+    parser.add_argument("--nrPoints", type=int, default=15)
+    parser.add_argument("--out", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.ip is not None:
+        from pepper_connector import socket_connection
+        connect = socket_connection(ip=args.ip, port=args.port, camera=args.camera)
+    elif args.replay is not None:
+        from wire_replay import ReplayConnection
+        connect = ReplayConnection(args.replay, realtime=args.realtime, loop=True)
+    elif args.stereo:
+        connect = SyntheticSource(1280, 360, frameDelay=args.frame_delay, stereo=True)
+    else:
+        connect = SyntheticSource(frameDelay=args.frame_delay)
+    if args.out is not None and not os.path.exists(args.out):
+        os.makedirs(args.out)
+
+    start = time.perf_counter()
+    header, profile, win = dryRun(connect, outDir=args.out, nrPoints=args.nrPoints,
+                                  refreshRate=args.refresh, realtime=args.realtime)
+    print('Dry run: {} frames, {} flips, {} dropped, {:.1f} s simulated, {:.1f} s wall'.format(
+        len(header), len(win.flipTimes), win.nDroppedFrames, clock.t, time.perf_counter() - start))
+    profile.summary()
@@ -1,17 +1,40 @@
+import json
 import socket
+import struct
+import threading
 import time
+import zlib
+from collections import OrderedDict
 
-import cv2
 import numpy as np
-from PIL import Image
 import argparse
 
+from stereo import STEREO_CAMERAS, splitStereo
+
+
+# Reply header of the getImgSeq command: robot side frame counter and capture
+# timestamp in seconds, followed by the usual YUV422 payload
+FRAME_HEADER = struct.Struct('<Qd')
+
+# Wire recordings: WIRE_MAGIC, one json line of connection settings, then
+# records of WIRE_RECORD (kind, seconds since start, length) and the payload.
+# Kinds are b'C' connected, b'S' bytes sent and b'R' bytes received.
+WIRE_MAGIC = b'PEPPERWIRE1\n'
+WIRE_RECORD = struct.Struct('<cdI')
+
+# Output formats of get_img: (colour mode, downscale factor). 'y' returns the
+# luma plane as a strided view of the received buffer, nothing is converted.
+OUTPUT_FORMATS = {'bgr': ('bgr', 1), 'bgr_half': ('bgr', 2), 'bgr_quarter': ('bgr', 4),
+                  'y': ('y', 1), 'y_half': ('y', 2), 'y_quarter': ('y', 4)}
+
 
 class socket_connection():
     """
     Class for creating socket connection and retrieving images
     """
-    def __init__(self, ip, port, camera, **kwargs):
+    def __init__(self, ip, port, camera, frame_timeout=1.0, cmd_timeout=0.5,
+                 connect_timeout=3.0, max_retries=5, backoff=0.25, seq_header=False,
+                 motion_rate=None, record=None, output='bgr', **kwargs):
         """
         Init of vars and creating socket connection object.
         Based on user input a different camera can be selected.
@@ -19,6 +42,26 @@ class socket_connection():
         2: Stereo camera 2560*720
         3: Mono camera 320*240
         4: Mono camera 640*480
+
+        frame_timeout is the deadline in seconds for receiving one full frame,
+        cmd_timeout the deadline for sending one command. The initial connect
+        is retried max_retries times with exponential backoff starting at
+        backoff seconds before a ConnectionError is raised. A lost link is
+        reopened with one attempt of at most frame_timeout per request, the
+        backoff between attempts is spread over the following requests.
+
+        With seq_header the robot is asked for getImgSeq replies that start
+        with FRAME_HEADER, so duplicate and skipped exposures are detected
+        from the frame counter. Otherwise a crc32 of the raw frame is used,
+        which only detects duplicates.
+
+        With motion_rate (commands per second) adjust_head and look go through
+        a MotionChannel that coalesces them and sends from its own thread.
+
+        With record every byte sent and received is written with its time
+        to that file, see wire_replay.py to play it back.
+
+        output selects what get_img returns, one of OUTPUT_FORMATS.
         """
         # Camera selection
         if camera == 1:
@@ -65,18 +108,170 @@ class socket_connection():
             print(f"Invalid camera selected... choose between 1 and 4, got {camera}")
             exit(1)
 
+        if output not in OUTPUT_FORMATS:
+            raise ValueError("Invalid output {}, choose from {}".format(output, sorted(OUTPUT_FORMATS)))
+        self.output = output
         self.COLOR_ID = 13
+        self.stereo = camera in STEREO_CAMERAS
         self.ip = ip
         self.port = port
+        self.frame_timeout = frame_timeout
+        self.cmd_timeout = cmd_timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.seq_header = seq_header
+        self.stats = {'frames': 0, 'timeouts': 0, 'partial_frames': 0,
+                      'resyncs': 0, 'reconnects': 0, 'send_errors': 0,
+                      'offline': 0, 'duplicates': 0, 'gaps': 0}
+        # Sequence info of the last frame, see _check_sequence
+        self.frame_info = {'seq': None, 'camTime': None, 'hash': None, 'dup': False, 'gap': 0,
+                           'tRecv': None}
+        # Skipped exposures are only counted between back to back requests
+        self.contiguous = False
+        # Last motion command of each kind that went out: kind -> (args, time sent)
+        self.last_motion = {}
+        # Serialises frame requests and commands from the motion thread
+        self.lock = threading.RLock()
+
+        self.recorder = None
+        if record is not None:
+            # Settings that change how the traffic is read, replayed with it
+            self.recorder = WireRecorder(record, {'camera': camera, 'seq_header': seq_header,
+                                                  'frame_timeout': frame_timeout, 'cmd_timeout': cmd_timeout,
+                                                  'output': output})
 
         # Initialize socket socket connection
-        self.s = socket.socket()
-        try:
-            self.s.connect((self.ip, self.port))
-            print("Successfully connected with {}:{}".format(self.ip, self.port))
-        except:
-            print("ERR: Failed to connect with {}:{}".format(self.ip, self.port))
-            exit(1)
+        self.s = None
+        # Set by close_connection, no sends or reconnects after that
+        self.closed = False
+        self.down = False
+        self.failures = 0
+        self.retry_at = 0.
+        if not self.connect():
+            raise ConnectionError("Failed to connect with {}:{}".format(self.ip, self.port))
+        self.motion = MotionChannel(self, motion_rate) if motion_rate else None
+
+    def connect(self, attempts=None, timeout=None):
+        """
+        (Re)open the socket with keepalive enabled, retrying with exponential
+        backoff. By default max_retries + 1 attempts of connect_timeout each
+        are made. Returns True on success.
+        """
+        if attempts is None:
+            attempts = self.max_retries + 1
+        if timeout is None:
+            timeout = self.connect_timeout
+        if self.s is not None:
+            self.s.close()
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(min(self.backoff * 2 ** (attempt - 1), 5.0))
+            self.s = self._new_socket()
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # Linux only, elsewhere the OS defaults are used
+            for opt, val in (('TCP_KEEPIDLE', 2), ('TCP_KEEPINTVL', 1), ('TCP_KEEPCNT', 3)):
+                if hasattr(socket, opt):
+                    self.s.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), val)
+            self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.s.settimeout(timeout)
+            try:
+                self.s.connect((self.ip, self.port))
+                print("Successfully connected with {}:{}".format(self.ip, self.port))
+                self.down = False
+                return True
+            except OSError:
+                print("ERR: Failed to connect with {}:{} (attempt {})".format(self.ip, self.port, attempt + 1))
+                self.s.close()
+        self.down = True
+        return False
+
+    def _new_socket(self):
+        if self.recorder is not None:
+            return RecordingSocket(socket.socket(), self.recorder)
+        return socket.socket()
+
+    def reconnect(self):
+        """
+        Make one connect attempt of at most frame_timeout so a dead link
+        costs the caller about one frame. After a failure no new attempt is
+        made until the backoff, which doubles with every failure, has passed.
+        Returns True if the connection is open.
+        """
+        if self.closed or time.time() < self.retry_at:
+            return False
+        self.stats['reconnects'] += 1
+        if self.connect(attempts=1, timeout=min(self.connect_timeout, self.frame_timeout)):
+            self.failures = 0
+            self.retry_at = 0.
+            return True
+        self.retry_at = time.time() + min(self.backoff * 2 ** self.failures, 5.0)
+        self.failures += 1
+        return False
+
+    def _send(self, payload):
+        """
+        Send a command within cmd_timeout, reconnecting once on failure.
+        Returns True if the command went out.
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            if self.down and not self.reconnect():
+                self.stats['offline'] += 1
+                return False
+            try:
+                self.s.settimeout(self.cmd_timeout)
+                self.s.sendall(payload)
+                return True
+            except OSError:
+                self.stats['send_errors'] += 1
+                if self.reconnect():
+                    try:
+                        self.s.sendall(payload)
+                        return True
+                    except OSError:
+                        self.stats['send_errors'] += 1
+                return False
+
+    def _recv_exact(self, buf, timeout):
+        """
+        Fill buf from the socket before the deadline. Returns the number of
+        bytes received, which is less than len(buf) on timeout or disconnect.
+        """
+        view = memoryview(buf)
+        n = 0
+        deadline = time.time() + timeout
+        while n < len(buf):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                self.s.settimeout(remaining)
+                r = self.s.recv_into(view[n:])
+            except socket.timeout:
+                break
+            except OSError:
+                return n
+            if r == 0:
+                return n
+            n += r
+        return n
+
+    def _resync(self, remaining):
+        """
+        Drop the rest of a frame that arrived partially so the next getImg
+        reply starts at a frame boundary. If the tail does not show up either
+        the stream position is unknown and the connection is reopened.
+        """
+        if self._recv_exact(bytearray(remaining), self.frame_timeout) == remaining:
+            self.stats['resyncs'] += 1
+        else:
+            self.reconnect()
+
+    def report_stats(self):
+        print("Connection stats: " + ", ".join("{}={}".format(k, v) for k, v in self.stats.items()))
+        return dict(self.stats)
 
 
     # def get_img(self):
@@ -97,18 +292,124 @@ class socket_connection():
     #     return cv_image[:, :, ::-1]
 
     def get_img(self):
-        #     """
-        #     Send signal to pepper to recieve image data, and convert to image data
-        #     """
-        self.s.send(b'getImg')
-        pepper_img = b""
+        """
+        Send signal to pepper to recieve image data, and convert to image data.
+        Returns None if the frame did not arrive within frame_timeout, the
+        stream is resynchronised so only this frame is lost. While the link
+        is down None is returned right away between reconnect attempts.
+        """
+        pepper_img = self.get_raw()
+        if pepper_img is None:
+            return None
+        return self.decode(pepper_img)
 
-        l = self.s.recv(self.size - len(pepper_img))
-        while len(pepper_img) < self.size:
-            pepper_img += l
-            l = self.s.recv(self.size - len(pepper_img))
+    def get_stereo(self):
+        """
+        Returns the left and right view of a stereo frame as views into one
+        decoded image, or None if the frame was lost
+        """
+        image = self.get_img()
+        if image is None:
+            return None
+        return splitStereo(image)
 
+    def get_raw(self):
+        """
+        Request one frame and return the raw YUV422 bytes, or None if it was
+        lost.
+        """
+        with self.lock:
+            return self._get_raw_locked()
+
+    def _get_raw_locked(self):
+        if self.seq_header:
+            if not self._send(b'getImgSeq'):
+                return None
+            total = FRAME_HEADER.size + self.size
+        else:
+            if not self._send(b'getImg'):
+                return None
+            total = self.size
+        buf = bytearray(total)
+        n = self._recv_exact(buf, self.frame_timeout)
+        if n < total:
+            if n == 0:
+                # Nothing arrived, a late reply would leave the stream
+                # misaligned so the connection is reopened right away
+                self.stats['timeouts'] += 1
+                self.reconnect()
+            else:
+                self.stats['partial_frames'] += 1
+                self._resync(total - n)
+            return None
+        self.stats['frames'] += 1
+        if self.seq_header:
+            seq, camTime = FRAME_HEADER.unpack_from(buf)
+            pepper_img = memoryview(buf)[FRAME_HEADER.size:]
+            self._check_sequence(pepper_img, seq, camTime)
+        else:
+            pepper_img = buf
+            self._check_sequence(pepper_img)
+        self.frame_info['tRecv'] = time.time()
+        return pepper_img
+
+    def reset_sequence(self):
+        """
+        Start a new run of back to back captures. The exposures the robot
+        makes while no frames are requested, e.g. between calibration dots,
+        are not counted as skipped for the next frame.
+        """
+        self.contiguous = False
+
+    def _check_sequence(self, pepper_img, seq=None, camTime=None):
+        """
+        Flag the frame as duplicate or count the skipped exposures before it
+        and store the result in frame_info
+        """
+        last = self.frame_info
+        dup = False
+        gap = 0
+        frameHash = None
+        if seq is not None:
+            if last['seq'] is not None:
+                dup = seq == last['seq']
+                if self.contiguous:
+                    # A lower counter means the robot side was restarted
+                    gap = max(seq - last['seq'] - 1, 0)
+        else:
+            frameHash = zlib.crc32(pepper_img)
+            dup = frameHash == last['hash']
+        if dup:
+            self.stats['duplicates'] += 1
+        if gap:
+            self.stats['gaps'] += 1
+        self.contiguous = True
+        self.frame_info = {'seq': seq, 'camTime': camTime, 'hash': frameHash, 'dup': dup, 'gap': gap,
+                           'tRecv': None}
+
+    def decode(self, pepper_img):
+        """
+        Convert raw YUV422 bytes to an image in the selected output format
+        """
+        mode, scale = OUTPUT_FORMATS[self.output]
         arr = np.frombuffer(pepper_img, dtype=np.uint8)
+        if mode == 'y':
+            # Every other byte is luma
+            y = arr[0::2].reshape(self.height, self.width)
+            return y[::scale, ::scale] if scale > 1 else y
+
+        # PIL is only needed here, keep it out of the import path
+        from PIL import Image
+
+        if scale > 1:
+            # Each YUYV macropixel (Y0 U Y1 V) covers two pixels, so at half
+            # resolution or less every output pixel has its own chroma and
+            # nothing needs to be upsampled
+            macro = arr.reshape(self.height, self.width // 2, 4)[::scale, ::scale // 2]
+            yuv = np.ascontiguousarray(macro[:, :, (0, 1, 3)])
+            image = Image.fromarray(yuv, 'YCbCr').convert('RGB')
+            return np.ascontiguousarray(np.asarray(image)[:, :, ::-1])
+
         y = arr[0::2]
         u = arr[1::4]
         v = arr[3::4]
@@ -120,8 +421,7 @@ class socket_connection():
         yuv[5::6] = v
         yuv = np.reshape(yuv, (self.height, self.width, 3))
         image = Image.fromarray(yuv, 'YCbCr').convert('RGB')
-        image = np.array(image)
-        image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+        image = np.ascontiguousarray(np.asarray(image)[:, :, ::-1])
 
         return image
 
@@ -129,31 +429,162 @@ class socket_connection():
         """
         Close socket connection after finishing
         """
-        return self.s.close()
+        if self.motion is not None:
+            self.motion.close()
+        with self.lock:
+            # A motion thread still running after close can not reopen it
+            self.closed = True
+            if self.recorder is not None:
+                self.recorder.close()
+            return self.s.close()
 
     def say(self, text):
-        self.s.sendall(bytes(f"say {text}".encode()))
+        self._send(bytes(f"say {text}".encode()))
 
     def enable_tracking(self):
-        self.s.sendall(bytes("track True".encode()))
+        self._send(bytes("track True".encode()))
 
     def disable_tracking(self):
-        self.s.sendall(bytes("track False".encode()))
+        self._send(bytes("track False".encode()))
 
     def nod(self):
-        self.s.sendall(bytes("nod".encode()))
+        self._send(bytes("nod".encode()))
+
+    def _motion(self, kind, payload, args):
+        if self.motion is not None:
+            self.motion.submit(kind, payload, args)
+        elif self._send(payload):
+            self.last_motion[kind] = (args, time.time())
 
     def adjust_head(self, pitch, yaw):
-        self.s.sendall(bytes("head {:0.2f} {:0.2f}".format(pitch, yaw).encode()))
+        self._motion('head', bytes("head {:0.2f} {:0.2f}".format(pitch, yaw).encode()), (pitch, yaw))
 
     def idle(self):
-        self.s.sendall(bytes("idle".encode()))
+        self._send(bytes("idle".encode()))
 
     def look(self, x, y):
-        self.s.sendall(bytes("look;{:0.5f};{:0.5f}".format(x, y).encode()))
+        self._motion('look', bytes("look;{:0.5f};{:0.5f}".format(x, y).encode()), (x, y))
+
+
+class WireRecorder():
+    """
+    Writes the traffic of a socket_connection to a wire recording
+    """
+    def __init__(self, path, meta):
+        self.f = open(path, 'wb', buffering=1 << 20)
+        self.f.write(WIRE_MAGIC)
+        self.f.write(json.dumps(meta).encode() + b'\n')
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def write(self, kind, data=b''):
+        with self.lock:
+            if self.f.closed:
+                return
+            self.f.write(WIRE_RECORD.pack(kind, time.perf_counter() - self.start, len(data)))
+            self.f.write(data)
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+class RecordingSocket():
+    """
+    Socket wrapper that passes everything through and records the bytes
+    that were actually sent and received
+    """
+    def __init__(self, sock, recorder):
+        self.sock = sock
+        self.recorder = recorder
+
+    def connect(self, address):
+        self.sock.connect(address)
+        self.recorder.write(b'C')
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.recorder.write(b'S', data)
+
+    def recv_into(self, buf):
+        r = self.sock.recv_into(buf)
+        if r:
+            self.recorder.write(b'R', buf[:r])
+        return r
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class MotionChannel():
+    """
+    Sends motion commands of a socket_connection from a worker thread. Only
+    the newest pending command of each kind is kept and at most max_rate
+    commands per second go out, so a stream of look/head updates can not
+    queue up in front of the getImg replies.
+    """
+    def __init__(self, connect, max_rate=10.):
+        self.connect = connect
+        self.period = 1. / max_rate
+        self.pending = OrderedDict()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.next_send = 0.
+        self.stats = {'requested': 0, 'sent': 0, 'coalesced': 0, 'failed': 0, 'dropped': 0}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, kind, payload, args):
+        with self.cond:
+            self.stats['requested'] += 1
+            if self.closed:
+                self.stats['dropped'] += 1
+                return
+            if kind in self.pending:
+                # Replacing keeps the position so other kinds are not starved
+                self.stats['coalesced'] += 1
+            self.pending[kind] = (payload, args)
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                wait = self.next_send - time.time()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                kind, (payload, args) = self.pending.popitem(last=False)
+            ok = self.connect._send(payload)
+            tSent = time.time()
+            self.next_send = tSent + self.period
+            if ok:
+                self.stats['sent'] += 1
+                self.connect.last_motion[kind] = (args, tSent)
+            else:
+                self.stats['failed'] += 1
+
+    def close(self, timeout=1.0):
+        """
+        Send what is still pending within timeout seconds and stop the
+        worker, commands still waiting for their rate limit are dropped
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join(timeout)
+        with self.cond:
+            self.stats['dropped'] += len(self.pending)
+            self.pending.clear()
+            self.cond.notify()
 
 
 if __name__ == '__main__':
+    import cv2
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--ip", type=str, default="10.15.3.25",
                         help="Robot IP address. Default 127.0.0.1")
@@ -162,8 +593,11 @@ if __name__ == '__main__':
     parser.add_argument("--cam_id", type=int, default=4,
                         help="Camera id according to pepper docs. Use 3 for "
                              "stereo camera and 0. Default is 3.")
+    parser.add_argument("--frame_timeout", type=float, default=1.0,
+                        help="Deadline in seconds for one frame. Default 1.0.")
     args = parser.parse_args()
-    connect = socket_connection(ip=args.ip, port=args.port, camera=args.cam_id)
+    connect = socket_connection(ip=args.ip, port=args.port, camera=args.cam_id,
+                                frame_timeout=args.frame_timeout)
 
     # connect.enable_tracking()
 
@@ -173,6 +607,9 @@ if __name__ == '__main__':
     while True:
         start_fps = time.time()
         img = connect.get_img()
+        if img is None:
+            connect.report_stats()
+            continue
 
         # if cv2.waitKey(1) & 0xFF == ord('q'):
         #     break
@@ -0,0 +1,357 @@
+"""
+Lightweight entry points that do not need psychopy.
+
+    capture  : grab frames from the robot and store them as JPEGs
+    replay   : play back a recorded session from its Header.p
+    index    : build one csv index over the frames of several sessions
+    manifest : hash and test-decode every frame of a session
+    verify   : check a session against its manifest, e.g. after a copy
+    dedup    : list byte-identical frames across sessions
+    disparity: offline disparity maps of stereo sessions
+
+Every heavy dependency is imported inside the command that uses it so that
+e.g. `python session_tools.py index` never loads cv2.
+"""
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import time
+from multiprocessing import Pool
+
+MANIFEST_COLS = ['fName', 'size', 'sha256', 'ok']
+
+
+def capture(ip, port, camera, outDir, nFrames=0, show=False, **kwargs):
+    """
+    Store frames from the robot in outDir until nFrames are saved (0 runs
+    until interrupted). Returns the connection stats.
+    """
+    import cv2
+    from pepper_connector import socket_connection
+
+    if not os.path.exists(outDir):
+        os.makedirs(outDir)
+    connect = socket_connection(ip=ip, port=port, camera=camera, **kwargs)
+    count = 0
+    start = time.time()
+    try:
+        while nFrames <= 0 or count < nFrames:
+            img = connect.get_img()
+            if img is None:
+                continue
+            cv2.imwrite(os.path.join(outDir, 'frame%05d.jpg' % count), img)
+            if show:
+                cv2.imshow('pepper stream', img)
+                cv2.waitKey(1)
+            count += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        duration = time.time() - start
+        print('Captured {} frames in {:.1f} s ({:.1f} fps)'.format(count, duration, count / max(duration, 1e-9)))
+        stats = connect.report_stats()
+        connect.close_connection()
+    return stats
+
+
+def findHeaders(root):
+    """
+    Returns the paths of all Header.p files in root and its participant
+    directories
+    """
+    return sorted(glob.glob(os.path.join(root, '*Header.p')) +
+                  glob.glob(os.path.join(root, '*', '*Header.p')))
+
+
+def replay(sessionDir, fps=33):
+    from calibration_experiment import dispCalVid
+
+    headers = findHeaders(sessionDir)
+    if not headers:
+        print('ERR: no Header.p found in {}'.format(sessionDir))
+        return
+    for header in headers:
+        dispCalVid(os.path.dirname(header), os.path.basename(header), fps=fps)
+
+
+def index(roots, outFile):
+    """
+    Concatenate the headers of all sessions found under roots into one csv.
+    Frame names are made relative to the index file.
+    """
+    import pandas as pd
+
+    frames = []
+    for root in roots:
+        for header in findHeaders(root):
+            data = pd.read_pickle(header)
+            session = os.path.dirname(header)
+            data['session'] = os.path.basename(session)
+            data['path'] = [os.path.relpath(os.path.join(session, f), os.path.dirname(os.path.abspath(outFile)))
+                            for f in data['fName']]
+            frames.append(data)
+    if not frames:
+        print('ERR: no sessions found')
+        return None
+    data = pd.concat(frames, ignore_index=True)
+    data.to_csv(outFile, index=False)
+    print('Indexed {} frames from {} sessions into {}'.format(len(data), len(frames), outFile))
+    return data
+
+
+def checkFrame(path):
+    """
+    Hash and test-decode one JPEG. Returns (path, stamp, sha256, ok) where
+    stamp is fileStamp() of the file, or None if it can not be read.
+    """
+    import cv2
+    import numpy as np
+
+    try:
+        st = os.stat(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return path, None, '', False
+    digest = hashlib.sha256(data).hexdigest()
+    # Truncated files lack the end of image marker, imdecode alone may accept them
+    ok = data[-2:] == b'\xff\xd9' and \
+        cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED) is not None
+    return path, fileStamp(st), digest, ok
+
+
+def fileStamp(st):
+    """
+    Size, mtime and inode of a file. Copies keep size and, with cp -a or
+    rsync -a, the mtime but not the inode.
+    """
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def checkFrames(paths, workers=None):
+    """
+    Run checkFrame over paths in a process pool, returns {path: result}
+    """
+    if not paths:
+        return {}
+    with Pool(workers) as pool:
+        return {r[0]: r for r in pool.imap_unordered(checkFrame, paths, chunksize=16)}
+
+
+def headerFrames(header):
+    import pandas as pd
+
+    data = pd.read_pickle(header)
+    cols = [c for c in ('fName', 'fNameR') if c in data]
+    return [f for c in cols for f in data[c] if isinstance(f, str)]
+
+
+def manifestPath(header):
+    return header[:-len('Header.p')] + 'Manifest.csv'
+
+
+def readCsv(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def writeCsv(path, cols, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(cols)
+        writer.writerows(rows)
+
+
+def writeManifest(header, workers=None):
+    """
+    Write the manifest of the frames listed in header. Returns the number of
+    frames that are missing or do not decode.
+    """
+    session = os.path.dirname(header)
+    names = headerFrames(header)
+    results = checkFrames([os.path.join(session, f) for f in names], workers)
+    rows = []
+    bad = 0
+    for f in names:
+        _, stamp, digest, ok = results[os.path.join(session, f)]
+        bad += not ok
+        rows.append([f, stamp[0] if stamp else -1, digest, int(ok)])
+    writeCsv(manifestPath(header), MANIFEST_COLS, rows)
+    print('{}: {} frames, {} bad'.format(manifestPath(header), len(rows), bad))
+    return bad
+
+
+def verifyManifest(header, workers=None, full=False):
+    """
+    Compare the frames of a session with its manifest. Frames verified before
+    whose size, mtime and inode did not change are skipped unless full is
+    set. That state is kept in a .verified file next to the manifest and is
+    only used by the session directory and manifest it was made for, so a
+    copied session is fully checked on its first verify. Returns the list of
+    frames that failed, or the manifest itself if it does not exist.
+    """
+    session = os.path.dirname(header)
+    manifest = manifestPath(header)
+    if not os.path.exists(manifest):
+        print('{}: FAILED, no manifest'.format(manifest))
+        return [os.path.basename(manifest)]
+    stateFile = manifest + '.verified'
+    with open(manifest, 'rb') as f:
+        owner = {'session': os.path.realpath(session), 'manifest': hashlib.sha256(f.read()).hexdigest()}
+    state = {}
+    if not full and os.path.exists(stateFile):
+        try:
+            with open(stateFile) as f:
+                saved = json.load(f)
+            if all(saved.get(k) == v for k, v in owner.items()):
+                state = saved['frames']
+        except (ValueError, KeyError):
+            pass
+
+    expected = {r['fName']: r for r in readCsv(manifest)}
+    todo = []
+    for f in expected:
+        try:
+            st = os.stat(os.path.join(session, f))
+        except OSError:
+            todo.append(f)
+            continue
+        if state.get(f) != fileStamp(st):
+            todo.append(f)
+    results = checkFrames([os.path.join(session, f) for f in todo], workers)
+
+    state = {f: state[f] for f in expected if f in state}
+    failed = []
+    for f in todo:
+        _, stamp, digest, ok = results[os.path.join(session, f)]
+        if ok and digest == expected[f]['sha256']:
+            state[f] = stamp
+        else:
+            state.pop(f, None)
+            failed.append(f)
+    with open(stateFile, 'w') as f:
+        json.dump(dict(owner, frames=state), f)
+    print('{}: {} checked, {} skipped, {} failed'.format(manifest, len(todo), len(expected) - len(todo), len(failed)))
+    for f in failed:
+        print('  FAILED ' + f)
+    return failed
+
+
+def findDuplicates(roots, outFile=None, workers=None):
+    """
+    Group byte-identical frames over all sessions under roots. Digests are
+    taken from the manifests where available. Returns {sha256: [paths]} of
+    the groups with more than one frame.
+    """
+    digests = {}
+    toHash = []
+    for root in roots:
+        for header in findHeaders(root):
+            session = os.path.dirname(header)
+            if os.path.exists(manifestPath(header)):
+                for r in readCsv(manifestPath(header)):
+                    digests.setdefault(r['sha256'], []).append(os.path.join(session, r['fName']))
+            else:
+                toHash += [os.path.join(session, f) for f in headerFrames(header)]
+    for path, stamp, digest, _ in checkFrames(toHash, workers).values():
+        if stamp is not None:
+            digests.setdefault(digest, []).append(path)
+
+    groups = {d: sorted(p) for d, p in digests.items() if d and len(p) > 1}
+    if outFile is not None:
+        writeCsv(outFile, ['sha256', 'path'], [[d, p] for d, paths in sorted(groups.items()) for p in paths])
+    print('{} groups of identical frames ({} redundant files)'.format(
+        len(groups), sum(len(p) - 1 for p in groups.values())))
+    return groups
+
+
+def disparity(roots, workers=None, numDisparities=64):
+    """
+    Compute the disparity of every stored left/right pair in a process pool
+    """
+    import pandas as pd
+    from functools import partial
+    from stereo import computeDisparity
+
+    pairs = []
+    for root in roots:
+        for header in findHeaders(root):
+            data = pd.read_pickle(header)
+            if 'fNameR' not in data:
+                continue
+            session = os.path.dirname(header)
+            pairs += [(os.path.join(session, l), os.path.join(session, r))
+                      for l, r in zip(data['fName'], data['fNameR']) if isinstance(r, str)]
+    with Pool(workers) as pool:
+        results = list(pool.imap_unordered(partial(computeDisparity, numDisparities=numDisparities),
+                                           pairs, chunksize=4))
+    failed = [path for path, ok in results if not ok]
+    print('{} disparity maps written, {} failed'.format(len(results) - len(failed), len(failed)))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('capture', help='Store frames without running the experiment')
+    p.add_argument("--ip", type=str, default="10.15.3.25")
+    p.add_argument("--port", type=int, default=12345)
+    p.add_argument("--camera", type=int, default=4)
+    p.add_argument("--out", type=str, default="test_images")
+    p.add_argument("--frames", type=int, default=0, help="Number of frames, 0 until ctrl-c")
+    p.add_argument("--show", action='store_true')
+    p.add_argument("--frame_timeout", type=float, default=1.0)
+    p.add_argument("--record", type=str, default=None, help="Write the wire traffic to this file")
+    p.add_argument("--output", type=str, default='bgr', help="Output format, e.g. bgr, y, y_half, bgr_quarter")
+
+    p = sub.add_parser('replay', help='Show the frames of a recorded session')
+    p.add_argument("session", type=str)
+    p.add_argument("--fps", type=int, default=33)
+
+    p = sub.add_parser('index', help='Build a csv index over session headers')
+    p.add_argument("roots", type=str, nargs='+')
+    p.add_argument("--out", type=str, default="index.csv")
+
+    p = sub.add_parser('manifest', help='Hash and test-decode the frames of each session')
+    p.add_argument("roots", type=str, nargs='+')
+    p.add_argument("--workers", type=int, default=None)
+
+    p = sub.add_parser('verify', help='Check sessions against their manifest')
+    p.add_argument("roots", type=str, nargs='+')
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--full", action='store_true', help="Also recheck frames verified before")
+
+    p = sub.add_parser('dedup', help='Find byte-identical frames across sessions')
+    p.add_argument("roots", type=str, nargs='+')
+    p.add_argument("--out", type=str, default=None)
+    p.add_argument("--workers", type=int, default=None)
+
+    p = sub.add_parser('disparity', help='Offline disparity of stereo sessions')
+    p.add_argument("roots", type=str, nargs='+')
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--num_disparities", type=int, default=64)
+
+    args = parser.parse_args()
+    if args.command == 'capture':
+        capture(args.ip, args.port, args.camera, args.out, args.frames, args.show,
+                frame_timeout=args.frame_timeout, record=args.record, output=args.output)
+    elif args.command == 'replay':
+        replay(args.session, args.fps)
+    elif args.command == 'index':
+        index(args.roots, args.out)
+    elif args.command == 'manifest':
+        bad = sum(writeManifest(h, args.workers) for r in args.roots for h in findHeaders(r))
+        exit(1 if bad else 0)
+    elif args.command == 'verify':
+        failed = sum(len(verifyManifest(h, args.workers, args.full)) for r in args.roots for h in findHeaders(r))
+        exit(1 if failed else 0)
+    elif args.command == 'dedup':
+        findDuplicates(args.roots, args.out, args.workers)
+    elif args.command == 'disparity':
+        exit(1 if disparity(args.roots, args.workers, args.num_disparities) else 0)
+    else:
+        parser.print_help()
@@ -0,0 +1,94 @@
+"""
+Stereo camera support for camera modes 1 and 2, which deliver the left and
+right view side by side in one frame.
+
+The calibration file is an .npz with either the rectification maps
+(map1x, map1y, map2x, map2y) or the output of cv2.stereoCalibrate
+(K1, D1, K2, D2, R, T) from which the maps are computed once at load.
+"""
+import os
+
+import numpy as np
+
+# Camera modes of socket_connection that deliver side by side stereo frames
+STEREO_CAMERAS = (1, 2)
+
+
+def splitStereo(img):
+    """
+    Returns the left and right half of a side by side frame as views, no
+    pixels are copied
+    """
+    half = img.shape[1] // 2
+    return img[:, :half], img[:, half:]
+
+
+class StereoRectifier():
+    """
+    Rectifies left/right views with precomputed remap tables
+
+    Parameters
+    ----------
+    path : string
+        .npz calibration file, see module docstring
+    size : tuple (width, height)
+        Full resolution size of one view. Required when the maps are
+        computed from the camera matrices, checked against stored maps.
+    scale : int
+        Downscale factor of the views that will be rectified, e.g. 2 for the
+        *_half output formats. The maps are reduced to match.
+    """
+    def __init__(self, path, size=None, scale=1):
+        import cv2
+
+        calib = np.load(path)
+        if 'map1x' in calib:
+            maps = [calib['map1x'], calib['map1y'], calib['map2x'], calib['map2y']]
+            if size is not None and maps[0].shape[:2] != (size[1], size[0]):
+                raise ValueError('{} has maps for {}x{} views, expected {}x{}'.format(
+                    path, maps[0].shape[1], maps[0].shape[0], size[0], size[1]))
+        else:
+            if size is None:
+                raise ValueError('size is required to compute the maps from {}'.format(path))
+            R1, R2, P1, P2, _, _, _ = cv2.stereoRectify(calib['K1'], calib['D1'], calib['K2'], calib['D2'],
+                                                        size, calib['R'], calib['T'], alpha=0)
+            maps = list(cv2.initUndistortRectifyMap(calib['K1'], calib['D1'], R1, P1, size, cv2.CV_32FC1)) + \
+                list(cv2.initUndistortRectifyMap(calib['K2'], calib['D2'], R2, P2, size, cv2.CV_32FC1))
+        if scale > 1:
+            # Reduced views keep every scale-th pixel, so the map of output
+            # pixel (u, v) is the full map at (u * scale, v * scale) / scale
+            maps = [np.ascontiguousarray(m[::scale, ::scale] / scale, dtype=np.float32) for m in maps]
+        self.shape = maps[0].shape[:2]
+        # Fixed point maps make remap about twice as fast
+        self.left = cv2.convertMaps(maps[0], maps[1], cv2.CV_16SC2)
+        self.right = cv2.convertMaps(maps[2], maps[3], cv2.CV_16SC2)
+
+    def rectify(self, left, right):
+        import cv2
+
+        # remap returns the map size whatever the input, a mismatch would
+        # silently store wrong pixels
+        if left.shape[:2] != self.shape or right.shape[:2] != self.shape:
+            raise ValueError('Views of {} and {} do not match the {}x{} rectification maps'.format(
+                left.shape[1::-1], right.shape[1::-1], self.shape[1], self.shape[0]))
+        return (cv2.remap(left, self.left[0], self.left[1], cv2.INTER_LINEAR),
+                cv2.remap(right, self.right[0], self.right[1], cv2.INTER_LINEAR))
+
+
+def computeDisparity(pair, numDisparities=64, blockSize=5):
+    """
+    Compute the SGBM disparity of one stored pair and write it next to the
+    left view as 16 bit png (disparity * 16). Returns (output path, ok).
+    """
+    import cv2
+
+    leftPath, rightPath = pair
+    left = cv2.imread(leftPath, cv2.IMREAD_GRAYSCALE)
+    right = cv2.imread(rightPath, cv2.IMREAD_GRAYSCALE)
+    outPath = os.path.splitext(leftPath)[0] + '_D.png'
+    if left is None or right is None:
+        return outPath, False
+    sgbm = cv2.StereoSGBM_create(minDisparity=0, numDisparities=numDisparities, blockSize=blockSize,
+                                 P1=8 * blockSize ** 2, P2=32 * blockSize ** 2)
+    disp = sgbm.compute(left, right)
+    return outPath, cv2.imwrite(outPath, np.clip(disp, 0, None).astype(np.uint16))
@@ -0,0 +1,191 @@
+"""
+Play back a wire recording made with socket_connection(record=...).
+
+ReplayConnection is a socket_connection whose socket serves the recorded
+bytes, so framing, resync, sequence checks and decoding run exactly as they
+did live. Each getImg request jumps to the next recorded frame request and
+the bytes received after it are replayed either at their original timing
+(optionally scaled by speed) or as fast as possible. Other commands are
+accepted and dropped.
+
+    python wire_replay.py session.wire             # decoder benchmark
+    python wire_replay.py session.wire --realtime
+    python headless.py --replay session.wire       # calibration() dry run
+"""
+import argparse
+import json
+import socket
+import time
+
+from pepper_connector import socket_connection, WIRE_MAGIC, WIRE_RECORD
+
+
+class WirePlayer():
+    """
+    Reads a wire recording and serves its bytes request by request
+    """
+    def __init__(self, path, realtime=True, speed=1., loop=False):
+        self.realtime = realtime
+        self.speed = speed
+        self.loop = loop
+        self.f = open(path, 'rb')
+        if self.f.read(len(WIRE_MAGIC)) != WIRE_MAGIC:
+            raise ValueError('{} is not a wire recording'.format(path))
+        self.meta = json.loads(self.f.readline().decode())
+        # (kind, time, payload offset, length), sent payloads are small and kept
+        self.records = []
+        self.sent = {}
+        while True:
+            head = self.f.read(WIRE_RECORD.size)
+            if len(head) < WIRE_RECORD.size:
+                break
+            kind, t, length = WIRE_RECORD.unpack(head)
+            offset = self.f.tell()
+            if kind == b'S':
+                self.sent[len(self.records)] = self.f.read(length)
+            else:
+                self.f.seek(length, 1)
+            self.records.append((kind, t, offset, length))
+        self.requests = [i for i, data in sorted(self.sent.items()) if data.startswith(b'getImg')]
+        self.req = 0
+        self.pos = len(self.records)
+        self.chunk = None
+        self.sendT = 0.
+        self.sendWall = 0.
+
+    def exhausted(self):
+        return self.req >= len(self.requests) and not (self.loop and self.requests)
+
+    def request(self, payload):
+        """
+        A frame request moves playback to the next recorded one
+        """
+        if not payload.startswith(b'getImg'):
+            return
+        if self.req >= len(self.requests):
+            if not (self.loop and self.requests):
+                self.pos = len(self.records)
+                return
+            self.req = 0
+        i = self.requests[self.req]
+        self.req += 1
+        self.pos = i + 1
+        self.chunk = None
+        self.sendT = self.records[i][1]
+        self.sendWall = time.perf_counter()
+
+    def read_into(self, buf, timeout):
+        """
+        Copy the next received bytes into buf. Raises socket.timeout where the
+        original connection got nothing more before its next request, returns
+        0 at the end of the recording.
+        """
+        if self.chunk is None:
+            while self.pos < len(self.records) and self.records[self.pos][0] == b'C':
+                self.pos += 1
+            if self.pos >= len(self.records):
+                return 0
+            kind, t, offset, length = self.records[self.pos]
+            if self.realtime:
+                wait = self.sendWall + (t - self.sendT) / self.speed - time.perf_counter()
+                if timeout is not None and wait > timeout:
+                    time.sleep(timeout)
+                    raise socket.timeout()
+                if wait > 0:
+                    time.sleep(wait)
+            if kind != b'R':
+                raise socket.timeout()
+            self.f.seek(offset)
+            self.chunk = memoryview(self.f.read(length))
+        n = min(len(buf), len(self.chunk))
+        buf[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        if not len(self.chunk):
+            self.chunk = None
+            self.pos += 1
+        return n
+
+
+class ReplaySocket():
+    """
+    The subset of socket.socket used by socket_connection, backed by a
+    WirePlayer
+    """
+    def __init__(self, player):
+        self.player = player
+        self.timeout = None
+
+    def connect(self, address):
+        if self.player.exhausted():
+            raise ConnectionRefusedError('End of wire recording')
+
+    def setsockopt(self, *args):
+        pass
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def sendall(self, data):
+        self.player.request(bytes(data))
+
+    def recv_into(self, buf):
+        return self.player.read_into(buf, self.timeout)
+
+    def close(self):
+        pass
+
+
+class ReplayConnection(socket_connection):
+    """
+    socket_connection that plays back a wire recording. get_img raises
+    EOFError once all recorded frames were served. The timeouts and output
+    format of the live connection are used unless given in kwargs.
+    """
+    def __init__(self, path, realtime=True, speed=1., loop=False, **kwargs):
+        self.player = WirePlayer(path, realtime, speed, loop)
+        kwargs.setdefault('max_retries', 0)
+        # Older recordings only store camera and seq_header
+        for key in ('frame_timeout', 'cmd_timeout', 'output'):
+            if key in self.player.meta:
+                kwargs.setdefault(key, self.player.meta[key])
+        super().__init__(ip=path, port=0, camera=self.player.meta['camera'],
+                         seq_header=self.player.meta['seq_header'], **kwargs)
+
+    def _new_socket(self):
+        return ReplaySocket(self.player)
+
+    def get_raw(self):
+        if self.player.exhausted():
+            raise EOFError('End of wire recording')
+        return super().get_raw()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recording", type=str)
+    parser.add_argument("--realtime", action='store_true', help="Keep the recorded timing")
+    parser.add_argument("--speed", type=float, default=1.0)
+    args = parser.parse_args()
+
+    connect = ReplayConnection(args.recording, realtime=args.realtime, speed=args.speed)
+    tRaw = tDecode = 0.
+    nFrames = 0
+    start = time.perf_counter()
+    while True:
+        t = time.perf_counter()
+        try:
+            raw = connect.get_raw()
+        except EOFError:
+            break
+        tRaw += time.perf_counter() - t
+        if raw is None:
+            continue
+        t = time.perf_counter()
+        connect.decode(raw)
+        tDecode += time.perf_counter() - t
+        nFrames += 1
+    duration = time.perf_counter() - start
+    print('{} frames in {:.2f} s ({:.1f} fps), receive {:.2f} ms, decode {:.2f} ms per frame'.format(
+        nFrames, duration, nFrames / max(duration, 1e-9), 1000 * tRaw / max(nFrames, 1),
+        1000 * tDecode / max(nFrames, 1)))
+    connect.report_stats()